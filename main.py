@@ -1,14 +1,61 @@
 import asyncio
-import json
+import html
 import os
 import re
+import sqlite3
 import time
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import closing
+from email.utils import parsedate_to_datetime
 from typing import Any
 
+import httpx
+import orjson
 import requests
+from aiolimiter import AsyncLimiter
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.request import HTTPXRequest
+from urllib3.util.retry import Retry
+
+
+# Doctor detail page URL, followed by the doctor code
+DETAIL_URL_BASE = 'https://servizi.apss.tn.it/ricmedico/medico.php?codMedicoMg='
+
+# Matches the "<b>Comune: XXX</b>" labels on doctor detail pages
+COMUNE_RE = re.compile(r'<b[^>]*>\s*Comune:\s*([^<]+?)\s*</b>', re.IGNORECASE)
+
+# Translation table escaping Telegram MarkdownV2 special characters
+MARKDOWN_ESCAPE = str.maketrans({c: f'\\{c}' for c in '_*[]()~`>#+-=|{}.!'})
+
+# Max length of a Telegram message (the hard limit is 4096 characters)
+MAX_MESSAGE_LENGTH = 4000
+
+# How many times a detail page answering 429 Too Many Requests is retried
+MAX_RATE_LIMIT_RETRIES = 3
+
+# Headers sent on every request to the APSS website
+HTTP_HEADERS = {
+    'User-Agent': (
+        'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
+        'Chrome/124.0 Safari/537.36'
+    ),
+    'Accept': 'text/html',
+    'Accept-Encoding': 'gzip, deflate',
+    'Accept-Language': 'it',
+}
+
+# Shared HTTP session: reuses connections to the APSS host across requests
+SESSION = requests.Session()
+SESSION.headers.update(HTTP_HEADERS)
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+))
 
 
 # Configuration Functions
@@ -19,50 +66,115 @@ def get_data_file_path() -> str:
     return os.path.join(data_dir, 'doctor_state.json')
 
 
-def load_state() -> dict[str, Any]:
+def load_state(file_path: str) -> dict[str, Any]:
     """
     Load doctor state from JSON file.
 
+    Args:
+        file_path: Path to doctor_state.json
+
     Returns:
-        dict with keys 'doctors' and 'location_cache'
-        Empty dicts if file doesn't exist
+        dict with key 'doctors' (plus 'location_cache' if written by an
+        older version, see import_location_cache())
+        Empty dict if file doesn't exist
     """
-    file_path = get_data_file_path()
     if os.path.exists(file_path):
         try:
-            with open(file_path, encoding='utf-8') as f:
-                return json.load(f)
-        except json.JSONDecodeError as e:
+            with open(file_path, 'rb') as f:
+                return orjson.loads(f.read())
+        except orjson.JSONDecodeError as e:
             print(f"Warning: Failed to parse state file: {e}")
             print("Starting with empty state")
-            return {'doctors': {}, 'location_cache': {}}
-    return {'doctors': {}, 'location_cache': {}}
+            return {'doctors': {}}
+    return {'doctors': {}}
 
 
-def save_state(state: dict[str, Any]) -> None:
+def serialize_state(state: dict[str, Any]) -> bytes:
+    """
+    Serialize doctor state to JSON.
+
+    Keys are sorted so the same state always gives the same bytes.
+    """
+    return orjson.dumps(state, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+
+
+def save_state(state: dict[str, Any], file_path: str) -> None:
     """
     Save doctor state to JSON file.
 
+    The state is written to a temporary file first and then renamed over the
+    real one, so an interrupted write never leaves a corrupt state file.
+
     Args:
-        state: dict with 'doctors' and 'location_cache' keys
+        state: dict with 'doctors' key
+        file_path: Path to doctor_state.json
     """
-    file_path = get_data_file_path()
     os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(state, f, indent=2, ensure_ascii=False)
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(serialize_state(state))
+    os.replace(tmp_path, file_path)
 
 
-def get_doctor_detail_url(doctor_id: str) -> str:
+def get_location_db_path() -> str:
+    """Get path to locations.db file."""
+    data_dir = os.getenv('DATA_DIR', '.')
+    return os.path.join(data_dir, 'locations.db')
+
+
+def open_location_db(file_path: str) -> sqlite3.Connection:
     """
-    Build detail URL for a doctor.
+    Open the SQLite location cache, creating it if needed.
 
     Args:
-        doctor_id: Doctor code
+        file_path: Path to locations.db
 
     Returns:
-        Full URL to doctor detail page
+        Connection to a DB with table
+        loc(doc_id, locations, ts, ok, etag, last_modified), where locations
+        is a JSON list of strings and ts a Unix timestamp
+    """
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    conn = sqlite3.connect(file_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS loc ('
+        'doc_id TEXT PRIMARY KEY, '
+        'locations TEXT NOT NULL, '
+        'ts INTEGER NOT NULL, '
+        'ok INTEGER NOT NULL DEFAULT 1, '
+        'etag TEXT, '
+        'last_modified TEXT)'
+    )
+
+    # Add HTTP validator columns to DBs created before they existed
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(loc)')}
+    for column in ('etag', 'last_modified'):
+        if column not in columns:
+            conn.execute(f'ALTER TABLE loc ADD COLUMN {column} TEXT')
+
+    return conn
+
+
+def import_location_cache(location_db: sqlite3.Connection, location_cache: dict[str, Any]) -> None:
     """
-    return f"https://servizi.apss.tn.it/ricmedico/medico.php?codMedicoMg={doctor_id}"
+    Import a location cache from the state file into the location DB.
+
+    Older versions kept the cache in doctor_state.json. Entries already in
+    the DB are left untouched.
+
+    Args:
+        location_db: Location cache DB connection
+        location_cache: dict mapping doctor ID to cache entry dicts
+    """
+    location_db.executemany(
+        'INSERT OR IGNORE INTO loc (doc_id, locations, ts, ok) VALUES (?, ?, ?, ?)',
+        [
+            (doc_id, orjson.dumps(cached['locations']).decode(), cached['timestamp'], cached.get('ok', True))
+            for doc_id, cached in location_cache.items()
+        ]
+    )
 
 
 def get_search_url() -> str:
@@ -94,10 +206,44 @@ def get_search_url() -> str:
         raise ValueError(f"Invalid SEARCH_MODE: {search_mode}. Must be 'ambito' or 'comune'")
 
 
-def scrape_doctor_list() -> list[dict[str, str]]:
+def load_config() -> dict[str, Any]:
+    """
+    Read configuration from env variables, once at startup.
+
+    Returns:
+        dict with keys:
+        - bot_token, channel_id: Telegram credentials
+        - search_url: URL for scraping doctor list
+        - state_path: path to doctor_state.json
+        - location_db_path: path to locations.db
+        - cache_expiry_seconds: location cache expiry
+        - neg_cache_expiry_seconds: location cache expiry for failed scrapes
+        - scrape_concurrency: max number of concurrent detail page scrapes
+        - scrape_rate: max number of detail page requests per second
+
+    Raises:
+        ValueError: if SEARCH_MODE is invalid or required params missing
+    """
+    return {
+        'bot_token': os.getenv('BOT_TOKEN'),
+        'channel_id': os.getenv('CHANNEL_ID'),
+        'search_url': get_search_url(),
+        'state_path': get_data_file_path(),
+        'location_db_path': get_location_db_path(),
+        'cache_expiry_seconds': int(os.getenv('LOCATION_CACHE_DAYS', '7')) * 24 * 3600,
+        'neg_cache_expiry_seconds': int(os.getenv('LOCATION_NEG_CACHE_MINUTES', '30')) * 60,
+        'scrape_concurrency': int(os.getenv('SCRAPE_CONCURRENCY', '5')),
+        'scrape_rate': float(os.getenv('SCRAPE_RATE', '5')),
+    }
+
+
+def scrape_doctor_list(url: str) -> list[dict[str, str]]:
     """
     Scrape list of doctors from APSS website.
 
+    Args:
+        url: Search URL from get_search_url()
+
     Returns:
         List of doctor dicts with keys:
         - id: doctor code (from medico.php?codMedicoMg=XXX)
@@ -109,28 +255,27 @@ def scrape_doctor_list() -> list[dict[str, str]]:
         requests.RequestException: on HTTP errors
         ValueError: if table structure doesn't match expected format
     """
-    url = get_search_url()
-    response = requests.get(url, timeout=30)
+    response = SESSION.get(url, timeout=30)
     response.raise_for_status()
-    soup = BeautifulSoup(response.text, 'html.parser')
+    soup = BeautifulSoup(response.content, 'lxml')
 
     doctors = []
 
     # Find table with doctor information
-    table = soup.find('table')
+    table = soup.select_one('table')
     if not table:
         raise ValueError("Doctor table not found in page")
 
     # Find tbody and get rows from there
-    tbody = table.find('tbody')
+    tbody = table.select_one('tbody')
     if not tbody:
         raise ValueError("Table body (tbody) not found in doctor table")
 
-    rows = tbody.find_all('tr')
+    rows = tbody.select('tr')
 
     # Process data rows
     for row in rows:
-        cols = row.find_all('td')
+        cols = row.select('td')
 
         if len(cols) < 4:
             raise ValueError(f"Expected at least 4 columns in doctor row, found {len(cols)}")
@@ -140,19 +285,17 @@ def scrape_doctor_list() -> list[dict[str, str]]:
         availability = cols[2].get_text(strip=True)
 
         # Extract doctor ID from detail link
-        detail_link = cols[3].find('a')
-        if not detail_link or 'href' not in detail_link.attrs:
+        detail_link = cols[3].select_one('a[href]')
+        if not detail_link:
             raise ValueError(f"No detail link found for doctor: {first_name} {last_name}")
 
         detail_url = detail_link['href']
 
         # Extract doctor ID from URL (medico.php?codMedicoMg=XXX)
-        match = re.search(r'codMedicoMg=([^&]+)', detail_url)
-        if not match:
+        doctor_id = detail_url.partition('codMedicoMg=')[2].partition('&')[0]
+        if not doctor_id:
             raise ValueError(f"Could not extract doctor ID from URL: {detail_url}")
 
-        doctor_id = match.group(1)
-
         doctors.append({
             'id': doctor_id,
             'first_name': first_name,
@@ -163,253 +306,379 @@ def scrape_doctor_list() -> list[dict[str, str]]:
     return doctors
 
 
-def scrape_doctor_locations(detail_url: str) -> list[str]:
+def parse_retry_after(value: str | None) -> float:
+    """
+    Parse a Retry-After header into seconds to wait.
+
+    Args:
+        value: Header value, either delay seconds or an HTTP date
+
+    Returns:
+        Seconds to wait (1 if the header is missing or invalid)
+    """
+    if not value:
+        return 1.0
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return 1.0
+
+
+async def scrape_doctor_locations(
+        client: httpx.AsyncClient,
+        limiter: AsyncLimiter,
+        detail_url: str,
+        etag: str | None = None,
+        last_modified: str | None = None
+) -> tuple[bool, list[str] | None, str | None, str | None]:
     """
     Scrape location information from individual doctor page.
 
+    If validators from a previous fetch are given, the request is
+    conditional and the server may answer 304 Not Modified without a body.
+
+    Requests go through the rate limiter; 429 responses are retried after
+    the delay given by the Retry-After header.
+
     Args:
+        client: Shared async HTTP client
+        limiter: Rate limiter shared by all scrapes
         detail_url: URL to doctor detail page (medico.php?codMedicoMg=XXX)
+        etag: ETag of the previous response, if any
+        last_modified: Last-Modified of the previous response, if any
 
     Returns:
-        List of location strings (e.g., ["ARCO", "RIVA DEL GARDA"])
-        Empty list if no locations found or on error
+        Tuple (ok, locations, etag, last_modified):
+        - ok: False if the page could not be fetched
+        - locations: list of location strings (e.g., ["ARCO", "RIVA DEL GARDA"]),
+          empty if no locations found or on error, None if not modified
+        - etag, last_modified: validators of the response, None if missing
     """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
     try:
-        response = requests.get(detail_url, timeout=30)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            async with limiter:
+                response = await client.get(detail_url, headers=headers)
+            if response.status_code != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+                break
+            delay = parse_retry_after(response.headers.get('Retry-After'))
+            print(f"Rate limited on {detail_url}, retrying in {delay:.0f}s")
+            await asyncio.sleep(delay)
 
-        locations = []
+        etag = response.headers.get('ETag', etag)
+        last_modified = response.headers.get('Last-Modified', last_modified)
 
-        # Find all <b> tags that contain "Comune:"
-        bold_tags = soup.find_all('b')
+        if response.status_code == 304:
+            return True, None, etag, last_modified
 
-        for tag in bold_tags:
-            text = tag.get_text(strip=True)
-            if text.startswith('Comune:'):
-                # Remove the "Comune: " prefix
-                location = text.replace('Comune:', '').strip()
-                if location and location not in locations:
-                    locations.append(location)
+        response.raise_for_status()
 
-        return locations
+        # A regex over the raw HTML is enough to pull out the "Comune:" labels,
+        # no need to build the whole DOM. dict.fromkeys dedupes preserving order.
+        locations = (html.unescape(m.group(1)).strip() for m in COMUNE_RE.finditer(response.text))
+        return True, list(dict.fromkeys(location for location in locations if location)), etag, last_modified
 
     except Exception as e:
         print(f"Warning: Failed to scrape locations from {detail_url}: {e}")
-        return []
-
-
-def get_doctor_locations(doctor_id: str, detail_url: str, location_cache: dict[str, Any]) -> list[str]:
+        return False, [], None, None
+
+
+async def get_doctor_locations(
+        client: httpx.AsyncClient,
+        semaphore: asyncio.Semaphore,
+        limiter: AsyncLimiter,
+        doctor_id: str,
+        detail_url: str,
+        location_db: sqlite3.Connection,
+        cache_expiry_seconds: int,
+        neg_cache_expiry_seconds: int
+) -> list[str]:
     """
     Get doctor locations from cache or scrape if needed.
 
     Args:
+        client: Shared async HTTP client
+        semaphore: Limits the number of concurrent scrapes
+        limiter: Limits the rate of requests
         doctor_id: Doctor code
         detail_url: URL to doctor detail page
-        location_cache: Current location cache dict
+        location_db: Location cache DB connection
+        cache_expiry_seconds: How long scraped locations stay cached
+        neg_cache_expiry_seconds: How long failed scrapes stay cached
 
     Returns:
         List of location strings
-        Updates location_cache with new data if scraped
+        Updates location_db with new data if scraped (not committed)
     """
-    cache_days = int(os.getenv('LOCATION_CACHE_DAYS', '7'))
-    cache_expiry_seconds = cache_days * 24 * 3600
     current_time = int(time.time())
 
-    # Check if cached and not expired
-    if doctor_id in location_cache:
-        cached = location_cache[doctor_id]
-        if current_time - cached['timestamp'] < cache_expiry_seconds:
-            return cached['locations']
+    # Check if cached and not expired (failed scrapes expire sooner)
+    row = location_db.execute(
+        'SELECT locations, ts, ok, etag, last_modified FROM loc WHERE doc_id = ?',
+        (doctor_id,)
+    ).fetchone()
+    etag = last_modified = None
+    if row:
+        cached_locations, cached_time, cached_ok, cached_etag, cached_last_modified = row
+        expiry_seconds = cache_expiry_seconds if cached_ok else neg_cache_expiry_seconds
+        if current_time - cached_time < expiry_seconds:
+            return orjson.loads(cached_locations)
+
+        # Expired - revalidate with the server instead of refetching blindly
+        if cached_ok:
+            etag, last_modified = cached_etag, cached_last_modified
 
     # Cache miss or expired - scrape
-    print(f"Scraping locations for doctor {doctor_id}...")
-    locations = scrape_doctor_locations(detail_url)
+    async with semaphore:
+        print(f"Scraping locations for doctor {doctor_id}...")
+        ok, locations, etag, last_modified = await scrape_doctor_locations(
+            client, limiter, detail_url, etag, last_modified
+        )
 
-    # Update cache
-    location_cache[doctor_id] = {
-        'locations': locations,
-        'timestamp': current_time
-    }
+    # Not modified - cached locations are still valid
+    if locations is None:
+        locations = orjson.loads(cached_locations)
 
-    # Rate limiting
-    time.sleep(1)
+    # Update cache
+    location_db.execute(
+        'INSERT OR REPLACE INTO loc (doc_id, locations, ts, ok, etag, last_modified) VALUES (?, ?, ?, ?, ?, ?)',
+        (doctor_id, orjson.dumps(locations).decode(), current_time, ok, etag, last_modified)
+    )
 
     return locations
 
 
-def detect_changes(
-        current_doctors: list[dict[str, str]],
+async def gather_locations(
+        to_fetch: list[tuple[str, str]],
+        location_db: sqlite3.Connection,
+        config: dict[str, Any]
+) -> dict[str, list[str]]:
+    """
+    Get locations for several doctors concurrently.
+
+    Args:
+        to_fetch: List of (doctor_id, detail_url) tuples
+        location_db: Location cache DB connection (will be updated)
+        config: dict from load_config()
+
+    Returns:
+        dict mapping doctor ID to its list of locations
+    """
+    if not to_fetch:
+        return {}
+
+    semaphore = asyncio.Semaphore(config['scrape_concurrency'])
+    limiter = AsyncLimiter(config['scrape_rate'], 1.0)
+    transport = httpx.AsyncHTTPTransport(retries=3)
+    async with httpx.AsyncClient(
+            headers=HTTP_HEADERS,
+            timeout=30,
+            transport=transport
+    ) as client:
+        results = await asyncio.gather(*[
+            get_doctor_locations(
+                client,
+                semaphore,
+                limiter,
+                doc_id,
+                detail_url,
+                location_db,
+                config['cache_expiry_seconds'],
+                config['neg_cache_expiry_seconds']
+            )
+            for doc_id, detail_url in to_fetch
+        ])
+
+    return {doc_id: locations for (doc_id, _), locations in zip(to_fetch, results)}
+
+
+async def detect_changes(
+        current_ids: dict[str, dict[str, Any]],
         previous_state: dict[str, Any],
-        location_cache: dict[str, Any]
+        location_db: sqlite3.Connection,
+        config: dict[str, Any]
 ) -> dict[str, Any]:
     """
     Detect changes between current scrape and previous state.
 
     Args:
-        current_doctors: List of doctor dicts from scrape_doctor_list()
+        current_ids: Current doctor dicts from scrape_doctor_list(), by ID
         previous_state: Previous state dict with 'doctors' key
-        location_cache: Location cache dict (will be updated)
+        location_db: Location cache DB connection (will be updated)
+        config: dict from load_config()
 
     Returns:
         dict with keys:
         - added: list of doctor dicts (new doctors)
         - removed: list of doctor dicts (removed doctors)
         - changed: list of tuples (doctor_dict, old_availability, new_availability)
-        - location_cache: updated location cache
     """
     changes = {
         'added': [],
         'removed': [],
-        'changed': [],
-        'location_cache': location_cache
+        'changed': []
     }
 
-    current_ids = {d['id']: d for d in current_doctors}
     previous_ids = previous_state.get('doctors', {})
 
-    # Detect added doctors
+    # Single pass over current doctors: classify as added or changed and
+    # collect the ones needing fresh locations
+    to_fetch = []
     for doc_id, doctor in current_ids.items():
-        if doc_id not in previous_ids:
-            # New doctor - fetch locations
-            locations = get_doctor_locations(
-                doctor['id'],
-                get_doctor_detail_url(doctor['id']),
-                location_cache
-            )
-            doctor['locations'] = locations
+        previous_doctor = previous_ids.get(doc_id)
+        if previous_doctor is None:
             changes['added'].append(doctor)
+        elif doctor['availability'] != previous_doctor['availability']:
+            changes['changed'].append((
+                doctor,
+                previous_doctor['availability'],
+                doctor['availability']
+            ))
+        else:
+            continue
+
+        # New doctor or status changed - fetch fresh locations
+        to_fetch.append((doc_id, f"{DETAIL_URL_BASE}{doc_id}"))
 
     # Detect removed doctors
     for doc_id, doctor in previous_ids.items():
         if doc_id not in current_ids:
             # Get locations from cache (may be stale but that's ok)
-            cached = location_cache.get(doc_id, {})
-            doctor['locations'] = cached.get('locations', [])
+            row = location_db.execute('SELECT locations FROM loc WHERE doc_id = ?', (doc_id,)).fetchone()
+            doctor['locations'] = orjson.loads(row[0]) if row else []
             changes['removed'].append(doctor)
 
-    # Detect availability changes
-    for doc_id, current_doctor in current_ids.items():
-        if doc_id in previous_ids:
-            previous_doctor = previous_ids[doc_id]
-            if current_doctor['availability'] != previous_doctor['availability']:
-                # Status changed - fetch fresh locations
-                locations = get_doctor_locations(
-                    current_doctor['id'],
-                    get_doctor_detail_url(current_doctor['id']),
-                    location_cache
-                )
-                current_doctor['locations'] = locations
-                changes['changed'].append((
-                    current_doctor,
-                    previous_doctor['availability'],
-                    current_doctor['availability']
-                ))
+    # Fetch all needed locations in one concurrent batch
+    locations_by_id = await gather_locations(to_fetch, location_db, config)
+    for doctor in changes['added']:
+        doctor['locations'] = locations_by_id[doctor['id']]
+    for doctor, _, _ in changes['changed']:
+        doctor['locations'] = locations_by_id[doctor['id']]
 
     return changes
 
 
 def escape_markdown(text: str) -> str:
     """Escape special characters for Telegram MarkdownV2."""
-    special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-    for char in special_chars:
-        text = text.replace(char, f'\\{char}')
-    return text
+    return text.translate(MARKDOWN_ESCAPE)
 
 
 def format_doctor(doctor: dict[str, Any]) -> str:
-    """Format single doctor entry."""
+    """Format single doctor entry (doctor['locations'] is set by detect_changes())."""
     name = f"{doctor['first_name']} {doctor['last_name']}"
-    locations = ', '.join(doctor.get('locations', [])) if doctor.get('locations') else 'N/A'
+    locations = ', '.join(doctor['locations']) or 'N/A'
     return f"  • *{escape_markdown(name)}* \\({escape_markdown(locations)}\\)"
 
 
-def format_telegram_message(changes: dict[str, Any]) -> str:
-    """
-    Format changes into a Telegram message with MarkdownV2.
-
-    Args:
-        changes: dict from detect_changes()
-
-    Returns:
-        Formatted message string with proper escaping
-    """
-    message_parts = []
-
+def iter_message_lines(changes: dict[str, Any]) -> Iterator[str]:
+    """Yield the lines of the Telegram message for the given changes."""
     # Header
-    message_parts.append("🏥 *Aggiornamento medici di medicina generale*")
+    yield "🏥 *Aggiornamento medici di medicina generale*"
 
     # Added doctors
     if changes['added']:
-        message_parts.append(f"➕ *Medici aggiunti* \\({len(changes['added'])}\\):")
+        yield f"➕ *Medici aggiunti* \\({len(changes['added'])}\\):"
 
         # Group added doctors by availability
-        availability_groups: dict[str, list] = {}
+        availability_groups: dict[str, list] = defaultdict(list)
         for doctor in changes['added']:
-            avail = doctor['availability']
-            if avail not in availability_groups:
-                availability_groups[avail] = []
-            availability_groups[avail].append(doctor)
+            availability_groups[doctor['availability']].append(doctor)
 
         for avail_status, doctors in availability_groups.items():
-            message_parts.append(f"\n_{escape_markdown(avail_status)}_:")
-            for doctor in doctors:
-                message_parts.append(format_doctor(doctor))
+            yield f"\n_{escape_markdown(avail_status)}_:"
+            yield from map(format_doctor, doctors)
 
     # Removed doctors
     if changes['removed']:
-        message_parts.append(f"\n➖ *Medici rimossi* \\({len(changes['removed'])}\\):")
-        for doctor in changes['removed']:
-            message_parts.append(format_doctor(doctor))
+        yield f"\n➖ *Medici rimossi* \\({len(changes['removed'])}\\):"
+        yield from map(format_doctor, changes['removed'])
 
     # Changed availability
     if changes['changed']:
-        message_parts.append(f"\n🔄 *Cambio disponibilità* \\({len(changes['changed'])}\\):")
+        yield f"\n🔄 *Cambio disponibilità* \\({len(changes['changed'])}\\):"
         for doctor, old_avail, new_avail in changes['changed']:
-            name = f"{doctor['first_name']} {doctor['last_name']}"
-            locations = ', '.join(doctor.get('locations', [])) if doctor.get('locations') else 'N/A'
-            message_parts.append(
-                f"  • *{escape_markdown(name)}* \\({escape_markdown(locations)}\\)\n"
-                f"    {escape_markdown(old_avail)} → {escape_markdown(new_avail)}"
-            )
+            yield f"{format_doctor(doctor)}\n    {escape_markdown(old_avail)} → {escape_markdown(new_avail)}"
 
-    return '\n'.join(message_parts)
 
+def format_telegram_messages(changes: dict[str, Any]) -> list[str]:
+    """
+    Format changes into Telegram messages with MarkdownV2.
 
-async def post_to_telegram(changes: dict[str, Any]) -> None:
+    Lines are packed into as few messages as possible, each within
+    MAX_MESSAGE_LENGTH (a single longer line still gets its own message).
+
+    Args:
+        changes: dict from detect_changes()
+
+    Returns:
+        List of formatted message strings with proper escaping
+    """
+    messages = []
+    lines: list[str] = []
+    length = 0
+    for line in iter_message_lines(changes):
+        if lines and length + 1 + len(line) > MAX_MESSAGE_LENGTH:
+            messages.append('\n'.join(lines).lstrip('\n'))
+            lines, length = [], 0
+        length += len(line) + (1 if lines else 0)
+        lines.append(line)
+    if lines:
+        messages.append('\n'.join(lines).lstrip('\n'))
+    return messages
+
+
+async def post_to_telegram(changes: dict[str, Any], config: dict[str, Any]) -> None:
     """
     Post changes to Telegram channel.
 
+    Long updates are split into several messages, sent over the same
+    connection; the link button is attached to the last one.
+
     Args:
         changes: dict from detect_changes()
+        config: dict from load_config()
 
     Raises:
         telegram.error.TelegramError: on posting failures
     """
-    bot = Bot(token=os.getenv('BOT_TOKEN'))
-    channel_id = os.getenv('CHANNEL_ID')
-
-    message = format_telegram_message(changes)
-
-    # Check message length (Telegram limit is 4096 characters)
-    if len(message) > 4000:
-        print("Warning: Message exceeds 4000 characters, might be truncated")
+    messages = format_telegram_messages(changes)
+    if len(messages) > 1:
+        print(f"Message too long, splitting into {len(messages)} messages")
 
     # Create inline keyboard with link to search page
     keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🔗 Cerca medico", url=get_search_url())]
+        [InlineKeyboardButton("🔗 Cerca medico", url=config['search_url'])]
     ])
 
-    await bot.send_message(
-        chat_id=channel_id,
-        text=message,
-        parse_mode='MarkdownV2',
-        reply_markup=keyboard,
-        disable_web_page_preview=True
-    )
+    request = HTTPXRequest(connection_pool_size=8)
+    async with Bot(token=config['bot_token'], request=request) as bot:
+        for i, message in enumerate(messages):
+            await bot.send_message(
+                chat_id=config['channel_id'],
+                text=message,
+                parse_mode='MarkdownV2',
+                reply_markup=keyboard if i == len(messages) - 1 else None,
+                disable_web_page_preview=True
+            )
 
 
 def main() -> int:
+    try:
+        return run()
+    finally:
+        SESSION.close()
+
+
+def run() -> int:
     # Load environment variables
     load_dotenv()
 
@@ -420,43 +689,53 @@ def main() -> int:
         print(f"Error: Missing required env vars: {', '.join(missing_vars)}")
         return 1
 
-    # Validate search URL can be built
-    search_url = get_search_url()
-    print(f"Search URL: {search_url}")
+    # Read configuration (also validates that the search URL can be built)
+    config = load_config()
+    print(f"Search URL: {config['search_url']}")
 
     # Check if first run
-    is_first_run = not os.path.exists(get_data_file_path())
+    is_first_run = not os.path.exists(config['state_path'])
 
     # Load previous state
-    state = load_state()
+    state = load_state(config['state_path'])
     print(f"Loaded state with {len(state.get('doctors', {}))} doctors")
 
+    # Canonical form of the loaded state, to skip saving when nothing changed
+    # (taken now because detect_changes updates the state objects in place)
+    loaded_state_json = serialize_state(state)
+
     # Scrape current doctor list
-    current_doctors = scrape_doctor_list()
+    current_doctors = scrape_doctor_list(config['search_url'])
     print(f"Scraped {len(current_doctors)} doctors")
 
     if not current_doctors:
         print("Error: No doctors found in scrape")
         return 1
 
+    current_ids = {d['id']: d for d in current_doctors}
+
     # First run: initialize state without posting
     if is_first_run:
         print("First run: initializing state")
 
         # Build initial state (don't fetch locations on first run)
         new_state = {
-            'doctors': {d['id']: d for d in current_doctors},
-            'location_cache': {}
+            'doctors': current_ids
         }
 
-        save_state(new_state)
+        save_state(new_state, config['state_path'])
         print(f"✓ Initialized state with {len(current_doctors)} doctors")
         print("Future runs will detect and post changes")
         return 0
 
     # Detect changes
-    location_cache = state.get('location_cache', {})
-    changes = detect_changes(current_doctors, state, location_cache)
+    with closing(open_location_db(config['location_db_path'])) as location_db:
+        # Move the location cache out of the state file, where older versions kept it
+        if 'location_cache' in state:
+            import_location_cache(location_db, state.pop('location_cache'))
+
+        changes = asyncio.run(detect_changes(current_ids, state, location_db, config))
+        location_db.commit()
 
     total_changes = len(changes['added']) + len(changes['removed']) + len(changes['changed'])
     print(f"Detected {total_changes} changes:")
@@ -466,20 +745,22 @@ def main() -> int:
 
     # Update state with current doctors
     new_state = {
-        'doctors': {d['id']: d for d in current_doctors},
-        'location_cache': changes['location_cache']
+        'doctors': current_ids
     }
 
     # Post to Telegram if there are changes
     if total_changes > 0:
-        asyncio.run(post_to_telegram(changes))
+        asyncio.run(post_to_telegram(changes, config))
         print("✓ Posted changes to Telegram")
     else:
         print("No changes to post")
 
     # Save updated state
-    save_state(new_state)
-    print("✓ State saved")
+    if serialize_state(new_state) == loaded_state_json:
+        print("State unchanged, not saving")
+    else:
+        save_state(new_state, config['state_path'])
+        print("✓ State saved")
 
     return 0
 